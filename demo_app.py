@@ -1,3 +1,4 @@
+import io
 import os
 import smtplib
 import ssl
@@ -7,6 +8,7 @@ from dotenv import load_dotenv
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 
 
@@ -26,48 +28,136 @@ if not file:
    st.stop()
 
 
-df = pd.read_csv(file)
+required_cols = ["Time", "User full name", "Event context", "Component", "Event name", "Origin"]
+# everything the dashboard reads; other Moodle columns are never parsed
+load_cols = required_cols + ["IP address"]
 
 
-# -------------------- Normalize column names (fix hidden spaces / weird chars) --------------------
-df.columns = (
-   df.columns.astype(str)
-   .str.replace("\ufeff", "", regex=False)
-   .str.replace("\r", "", regex=False)
-   .str.strip()
-)
+content_view_events = {"Section viewed", "Page viewed", "Resource viewed", "URL viewed", "File viewed", "Course module viewed"}
+submission_events = {"Assignment submitted", "Quiz attempted", "Quiz submission submitted", "Post created"}
+
+
+# Moodle log exports seen in the wild; an explicit format avoids per-row dateutil parsing
+time_formats = ["%d/%m/%y, %H:%M:%S", "%d/%m/%Y, %H:%M:%S", "%d/%m/%y, %H:%M", "%d/%m/%Y, %H:%M", "%Y-%m-%d %H:%M:%S"]
+
+
+# low-cardinality text columns, stored as category
+category_cols = ["User full name", "Event name", "Event context", "Component", "Origin"]
+
+
+def sniff_time_format(sample):
+   for fmt in time_formats:
+      try:
+         pd.to_datetime(sample, format=fmt)
+         return fmt
+      except (ValueError, TypeError):
+         continue
+   return None
+
+
+def parse_time(col):
+   time_sample = col.dropna()
+   fmt = sniff_time_format(str(time_sample.iloc[0])) if not time_sample.empty else None
+   if not fmt:
+      return pd.to_datetime(col, dayfirst=True, errors="coerce")
+   parsed = pd.to_datetime(col, format=fmt, errors="coerce")
+   # rows in a different layout than the sampled one get the dayfirst parse instead of being dropped
+   missed = parsed.isna() & col.notna()
+   if missed.any():
+      parsed[missed] = pd.to_datetime(col[missed], dayfirst=True, errors="coerce")
+   return parsed
+
+
+def normalize_columns(columns):
+   # fix hidden spaces / weird chars
+   return (
+      columns.astype(str)
+      .str.replace("\ufeff", "", regex=False)
+      .str.replace("\r", "", regex=False)
+      .str.strip()
+   )
+
+
+def event_mask(events_col, events):
+   # compare int category codes instead of hashing event-name strings
+   codes = events_col.cat.categories.get_indexer(list(events))
+   return np.isin(events_col.cat.codes.to_numpy(), codes[codes >= 0])
+
+
+# -------------------- Load + parse (cached on the uploaded bytes) --------------------
+@st.cache_data(show_spinner="Parsing log...")
+def load_log(file_bytes: bytes) -> pd.DataFrame:
+   header = pd.read_csv(io.BytesIO(file_bytes), nrows=0).columns
+   names = normalize_columns(header)
+
+   # missing columns are reported by the caller, outside the cache
+   if any(c not in names for c in required_cols):
+      return pd.DataFrame(columns=names)
+
+   # raw header names, since usecols is matched before column names are normalized
+   usecols = [raw for raw, name in zip(header, names) if name in load_cols]
+
+   try:
+      # multithreaded Arrow parser; the default engine handles anything it rejects
+      df = pd.read_csv(io.BytesIO(file_bytes), engine="pyarrow", usecols=usecols)
+   except (ImportError, ValueError):
+      df = pd.read_csv(io.BytesIO(file_bytes), usecols=usecols)
+   df.columns = normalize_columns(df.columns)
+
+   if not pd.api.types.is_datetime64_any_dtype(df["Time"]):
+      df["Time"] = parse_time(df["Time"])
+   df = df.dropna(subset=["Time"]).copy()
+   # midnight-normalized datetime64, so date compares stay vectorized
+   df["Date"] = df["Time"].dt.normalize()
+   # categories stay sorted and limited to rows that survived, so they double as filter options
+   for col in category_cols:
+      df[col] = df[col].astype("category").cat.remove_unused_categories()
+
+   # blank origins filled once here; used by the origin options, origin filter and cli drop
+   origin = df["Origin"]
+   if "(blank)" not in origin.cat.categories:
+      origin = origin.cat.add_categories("(blank)")
+   df["Origin_norm"] = origin.fillna("(blank)").cat.remove_unused_categories()
+
+   # event-type flags never depend on the filters, so they are computed once here
+   df["_is_content"] = event_mask(df["Event name"], content_view_events)
+   df["_is_course"] = event_mask(df["Event name"], ["Course viewed"])
+   df["_is_sub"] = event_mask(df["Event name"], submission_events)
+   return df
+
+
+@st.cache_data
+def sidebar_options(df: pd.DataFrame):
+   course_options = ["(All)"] + df["Event context"].cat.categories.tolist()
+   origin_options = ["(All)"] + sorted(df["Origin_norm"].cat.categories)
+   event_options = df["Event name"].cat.categories.tolist()
+   return course_options, origin_options, event_options, df["Time"].min(), df["Time"].max()
+
+
+df = load_log(file.getvalue())
 
 
 # -------------------- Validate columns --------------------
-required_cols = ["Time", "User full name", "Event context", "Component", "Event name", "Origin"]
 missing = [c for c in required_cols if c not in df.columns]
 if missing:
    st.error(f"Your CSV is missing columns: {missing}\n\nColumns found:\n{', '.join(df.columns)}")
    st.stop()
 
 
-# -------------------- Parse Time --------------------
-df["Time"] = pd.to_datetime(df["Time"], dayfirst=True, errors="coerce")
-df = df.dropna(subset=["Time"]).copy()
-df["Date"] = df["Time"].dt.date
-
-
 # -------------------- Sidebar filters --------------------
 st.sidebar.header("Filters")
 
 
-course_options = ["(All)"] + sorted(df["Event context"].dropna().unique().tolist())
+course_options, origin_options, event_options, min_dt, max_dt = sidebar_options(df)
+
+
 course = st.sidebar.selectbox("Course / Context", course_options)
 
 
-origin_options = ["(All)"] + sorted(df["Origin"].fillna("(blank)").unique().tolist())
 default_origin_idx = origin_options.index("web") if "web" in origin_options else 0
 origin = st.sidebar.selectbox("Origin", origin_options, index=default_origin_idx)
 
 
-event_options = sorted(df["Event name"].dropna().unique().tolist())
-
-
 default_events = [
    "Course viewed",
    "Section viewed",
@@ -97,7 +187,6 @@ selected_events = st.sidebar.multiselect(
 )
 
 
-min_dt, max_dt = df["Time"].min(), df["Time"].max()
 date_range = st.sidebar.date_input(
    "Date range",
    value=(min_dt.date(), max_dt.date()),
@@ -113,28 +202,33 @@ risk_inactive_days = st.sidebar.slider("At-risk if inactive more than (days)", 7
 search_name = st.sidebar.text_input("Search student name (optional)")
 
 
-# -------------------- Apply filters --------------------
-f = df.copy()
+# -------------------- Apply filters (cached per filter combination; bounded, entries can be near log-sized) --------------------
+@st.cache_data(max_entries=8)
+def apply_filters(df, course, origin, start_date, end_date, selected_events):
+   # one boolean mask, sliced once at the end
+   mask = np.ones(len(df), dtype=bool)
 
+   if course != "(All)":
+      mask &= (df["Event context"] == course).to_numpy()
 
-if course != "(All)":
-   f = f[f["Event context"] == course]
+   if origin != "(All)":
+      mask &= (df["Origin_norm"] == origin).to_numpy()
 
+   start_ts, end_ts = pd.Timestamp(start_date), pd.Timestamp(end_date) + pd.Timedelta(days=1)
+   mask &= ((df["Date"] >= start_ts) & (df["Date"] < end_ts)).to_numpy()
 
-if origin != "(All)":
-   f = f[f["Origin"].fillna("(blank)") == origin]
+   if selected_events:
+      mask &= event_mask(df["Event name"], selected_events)
 
+   # drop cli if any remains
+   mask &= (df["Origin_norm"] != "cli").to_numpy()
+   return df.loc[mask]
 
-start_date, end_date = date_range
-f = f[(f["Date"] >= start_date) & (f["Date"] <= end_date)]
-
-
-if selected_events:
-   f = f[f["Event name"].isin(selected_events)]
 
-
-# drop cli if any remains
-f = f[f["Origin"].fillna("") != "cli"]
+start_date, end_date = date_range
+# identifies the filtered frame for the per-chart caches below (file_id changes per upload)
+filter_key = (file.file_id, course, origin, start_date, end_date, tuple(sorted(selected_events)))
+f = apply_filters(df, *filter_key[1:])
 
 
 if f.empty:
@@ -143,36 +237,40 @@ if f.empty:
 
 
 # -------------------- Compute summary metrics --------------------
-today = pd.Timestamp.now().normalize()
-cutoff = (today - pd.Timedelta(days=lookback_days)).date()
-
-
-content_view_events = {"Section viewed", "Page viewed", "Resource viewed", "URL viewed", "File viewed", "Course module viewed"}
-submission_events = {"Assignment submitted", "Quiz attempted", "Quiz submission submitted", "Post created"}
-
-
-summary = f.groupby("User full name").agg(
-   last_access=("Time", "max"),
-   total_events=("Event name", "count"),
-   active_days=("Date", lambda x: pd.Series(x).loc[pd.Series(x) >= cutoff].nunique()),
-   content_views=("Event name", lambda x: x.isin(content_view_events).sum()),
-   course_views=("Event name", lambda x: (x == "Course viewed").sum()),
-   submissions=("Event name", lambda x: x.isin(submission_events).sum()),
-).reset_index()
-
-
-summary["inactive_days"] = (today - summary["last_access"].dt.normalize()).dt.days
-
+@st.cache_data(max_entries=8)
+def compute_summary(f, today, lookback_days, risk_inactive_days):
+   cutoff = today - pd.Timedelta(days=lookback_days)
+
+   # in-window dates only (NaT otherwise), so nunique counts active days; the event flags come from load_log
+   g = f.assign(_recent_date=f["Date"].where(f["Date"] >= cutoff))
+
+   summary = g.groupby("User full name", observed=True).agg(
+      last_access=("Time", "max"),
+      total_events=("Event name", "count"),
+      active_days=("_recent_date", "nunique"),
+      content_views=("_is_content", "sum"),
+      course_views=("_is_course", "sum"),
+      submissions=("_is_sub", "sum"),
+   ).reset_index()
+
+   summary["inactive_days"] = (today - summary["last_access"].dt.normalize()).dt.days
+
+   status_conditions = [
+      (summary["inactive_days"] > risk_inactive_days) | (summary["active_days"] == 0),
+      summary["active_days"] <= 2,
+   ]
+   summary["status"] = pd.Categorical(
+      np.select(status_conditions, ["⚠️ At Risk", "🟡 Warning"], default="✅ Active"),
+      categories=["⚠️ At Risk", "🟡 Warning", "✅ Active"],
+      ordered=True,
+   )
 
-def status_row(row):
-   if row["inactive_days"] > risk_inactive_days or row["active_days"] == 0:
-       return "⚠️ At Risk"
-   if row["active_days"] <= 2:
-       return "🟡 Warning"
-   return "✅ Active"
+   # sort: at risk first, then by inactivity
+   return summary.sort_values(["status", "inactive_days"], ascending=[True, False])
 
 
-summary["status"] = summary.apply(status_row, axis=1)
+today = pd.Timestamp.now().normalize()
+summary = compute_summary(f, today, lookback_days, risk_inactive_days)
 
 
 # optional name search (after aggregation)
@@ -180,12 +278,6 @@ if search_name.strip():
    summary = summary[summary["User full name"].str.contains(search_name, case=False, na=False)]
 
 
-# sort: at risk first, then by inactivity
-order = {"⚠️ At Risk": 0, "🟡 Warning": 1, "✅ Active": 2}
-summary["status_rank"] = summary["status"].map(order)
-summary = summary.sort_values(["status_rank", "inactive_days"], ascending=[True, False]).drop(columns=["status_rank"])
-
-
 # -------------------- KPI Row --------------------
 c1, c2, c3, c4, c5 = st.columns(5)
 c1.metric("Students", int(summary["User full name"].nunique()))
@@ -207,15 +299,16 @@ if at_risk.empty:
    st.success("No students are currently flagged as At Risk 🎉")
 else:
    cols = st.columns(3)
-   for i, (_, r) in enumerate(at_risk.iterrows()):
+   card_cols = ["User full name", "inactive_days", "active_days", "content_views", "submissions", "last_access"]
+   for i, (name, inactive, active, content, subs, last) in enumerate(at_risk[card_cols].itertuples(index=False, name=None)):
        with cols[i % 3]:
            st.error(
-               f"**{r['User full name']}**\n\n"
-               f"Inactive: **{int(r['inactive_days'])} days**\n\n"
-               f"Active days (last {lookback_days}d): **{int(r['active_days'])}**\n\n"
-               f"Content views: **{int(r['content_views'])}**\n\n"
-               f"Submissions: **{int(r['submissions'])}**\n\n"
-               f"Last access: **{r['last_access'].strftime('%Y-%m-%d %H:%M:%S')}**"
+               f"**{name}**\n\n"
+               f"Inactive: **{int(inactive)} days**\n\n"
+               f"Active days (last {lookback_days}d): **{int(active)}**\n\n"
+               f"Content views: **{int(content)}**\n\n"
+               f"Submissions: **{int(subs)}**\n\n"
+               f"Last access: **{last.strftime('%Y-%m-%d %H:%M:%S')}**"
            )
 
 
@@ -234,6 +327,17 @@ smtp_pass = os.getenv("SMTP_PASS")
 smtp_srv = os.getenv("SMTP_SERVER", "smtp.gmail.com")
 smtp_port = int(os.getenv("SMTP_PORT", "587"))
 
+# sanitize SMTP credentials to ASCII (SMTP auth requires ASCII);
+# common smart quotes / dashes -> ascii equivalents in a single translate pass
+_SMART = str.maketrans({"\u201c": '"', "\u201d": '"', "\u2018": "'", "\u2019": "'", "\u2013": "-", "\u2014": "-"})
+
+
+def _to_ascii(s: str) -> str:
+   if s is None:
+      return s
+   return unicodedata.normalize('NFKD', s.translate(_SMART)).encode('ascii', 'ignore').decode('ascii')
+
+
 if st.button("📩 Send alert email", type="primary"):
    if at_risk.empty:
       st.info("No at-risk students to notify.")
@@ -246,8 +350,10 @@ if st.button("📩 Send alert email", type="primary"):
             f"Students flagged as At Risk: {len(at_risk)}",
             "",
          ]
-         for _, r in at_risk.iterrows():
-            body_lines.append(f"{r['User full name']} — Inactive {int(r['inactive_days'])} days — Active days: {int(r['active_days'])}")
+         names = at_risk["User full name"].to_numpy()
+         inact = at_risk["inactive_days"].to_numpy()
+         act = at_risk["active_days"].to_numpy()
+         body_lines += [f"{n} — Inactive {int(i)} days — Active days: {int(a)}" for n, i, a in zip(names, inact, act)]
          body = "\n".join(body_lines)
 
          msg = EmailMessage()
@@ -257,16 +363,6 @@ if st.button("📩 Send alert email", type="primary"):
          msg.set_content(body)
 
          try:
-            # sanitize SMTP credentials to ASCII (SMTP auth requires ASCII)
-            def _to_ascii(s: str) -> str:
-               if s is None:
-                  return s
-               # common smart quotes / dashes -> ascii equivalents
-               s = s.replace(""", '"').replace(""", '"').replace("'", "'").replace("'", "'")
-               s = s.replace("–", "-").replace("—", "-")
-               s = unicodedata.normalize('NFKD', s)
-               return s.encode('ascii', 'ignore').decode('ascii')
-
             login_user = _to_ascii(smtp_user) if smtp_user else None
             login_pass = _to_ascii(smtp_pass) if smtp_pass else None
             if (smtp_user and login_user != smtp_user) or (smtp_pass and login_pass != smtp_pass):
@@ -316,6 +412,55 @@ if st.session_state.get("notif_log"):
       st.text("\n".join(st.session_state.notif_log))
 
 
+# -------------------- Chart data (cached per filter combination; "_f" is not hashed) --------------------
+@st.cache_data
+def daily_counts(filter_key, _f):
+   return _f.groupby("Date", observed=True).size().reset_index(name="events")
+
+
+@st.cache_data
+def top_events(filter_key, _f):
+   counts = _f["Event name"].value_counts(sort=False)
+   evt = counts[counts > 0].nlargest(15).reset_index()
+   evt.columns = ["event_name", "count"]
+   return evt
+
+
+# -------------------- Download payload (re-encoded only when the summary changes) --------------------
+@st.cache_data
+def summary_csv_bytes(summary: pd.DataFrame) -> bytes:
+   return summary.to_csv(index=False).encode("utf-8")
+
+
+# -------------------- Figures (cached on the small frames they plot) --------------------
+@st.cache_data
+def risk_bar(top30):
+   fig = px.bar(
+      top30,
+      x="User full name",
+      y="inactive_days",
+      color="status",
+      hover_data=["last_access", "active_days", "total_events", "content_views", "submissions"],
+      title="Top 30 students by inactive days"
+   )
+   fig.update_layout(xaxis_title="Student", yaxis_title="Inactive Days", xaxis_tickangle=-45)
+   return fig
+
+
+@st.cache_data
+def event_bar(evt):
+   fig = px.bar(evt, x="event_name", y="count", title="Top 15 event types (filtered)")
+   fig.update_layout(xaxis_title="Event name", yaxis_title="Count", xaxis_tickangle=-30)
+   return fig
+
+
+@st.cache_data
+def student_bar(breakdown, student):
+   fig = px.bar(breakdown, x="event_name", y="count", title=f"Top events for {student}")
+   fig.update_layout(xaxis_tickangle=-30)
+   return fig
+
+
 # -------------------- Tabs --------------------
 tab1, tab2, tab3 = st.tabs(["📋 Engagement Table", "📈 Visualisations", "🔍 Student Detail"])
 
@@ -324,21 +469,24 @@ with tab1:
    st.subheader("Engagement Summary (color-coded)")
 
 
-   def style_status(row):
-       s = row["status"]
-       if s == "⚠️ At Risk":
-           return ["background-color: #ffe5e5"] * len(row)  # light red
-       if s == "🟡 Warning":
-           return ["background-color: #fff6d6"] * len(row)  # light yellow
-       return ["background-color: #e9f7ef"] * len(row)      # light green
+   status_colors = {
+       "⚠️ At Risk": "background-color: #ffe5e5",  # light red
+       "🟡 Warning": "background-color: #fff6d6",   # light yellow
+       "✅ Active": "background-color: #e9f7ef",    # light green
+   }
+   # one CSS string per cell, built in a single vectorized step and applied with one Styler call
+   row_colors = summary["status"].map(status_colors).to_numpy()
+   styles = pd.DataFrame(
+       np.broadcast_to(row_colors[:, None], summary.shape), index=summary.index, columns=summary.columns
+   )
 
 
-   st.dataframe(summary.style.apply(style_status, axis=1), use_container_width=True)
+   st.dataframe(summary.style.apply(lambda _: styles, axis=None), use_container_width=True)
 
 
    st.download_button(
        "⬇️ Download summary CSV",
-       data=summary.to_csv(index=False).encode("utf-8"),
+       data=summary_csv_bytes(summary),
        file_name="engagement_summary.csv",
        mime="text/csv"
    )
@@ -348,28 +496,18 @@ with tab2:
    st.subheader("Risk overview (names + clear status)")
 
 
-   fig = px.bar(
-       summary.sort_values("inactive_days", ascending=False).head(30),
-       x="User full name",
-       y="inactive_days",
-       color="status",
-       hover_data=["last_access", "active_days", "total_events", "content_views", "submissions"],
-       title="Top 30 students by inactive days"
-   )
-   fig.update_layout(xaxis_title="Student", yaxis_title="Inactive Days", xaxis_tickangle=-45)
+   fig = risk_bar(summary.nlargest(30, "inactive_days"))
    st.plotly_chart(fig, use_container_width=True)
 
 
    st.subheader("Events over time")
-   daily = f.groupby("Date").size().reset_index(name="events")
+   daily = daily_counts(filter_key, f)
    st.line_chart(daily, x="Date", y="events")
 
 
    st.subheader("Top event types")
-   evt = f["Event name"].value_counts().head(15).reset_index()
-   evt.columns = ["event_name", "count"]
-   fig2 = px.bar(evt, x="event_name", y="count", title="Top 15 event types (filtered)")
-   fig2.update_layout(xaxis_title="Event name", yaxis_title="Count", xaxis_tickangle=-30)
+   evt = top_events(filter_key, f)
+   fig2 = event_bar(evt)
    st.plotly_chart(fig2, use_container_width=True)
 
 
@@ -400,8 +538,8 @@ with tab3:
 
 
        st.write("Event breakdown (this student)")
-       breakdown = sf["Event name"].value_counts().reset_index()
+       breakdown = sf["Event name"].value_counts(sort=False)
+       breakdown = breakdown[breakdown > 0].nlargest(20).reset_index()
        breakdown.columns = ["event_name", "count"]
-       fig3 = px.bar(breakdown.head(20), x="event_name", y="count", title=f"Top events for {student}")
-       fig3.update_layout(xaxis_tickangle=-30)
+       fig3 = student_bar(breakdown, student)
        st.plotly_chart(fig3, use_container_width=True)
\ No newline at end of file